@@ -1,7 +1,15 @@
 import argparse
+import hashlib
+import io
+import json
+import os
+import queue
+import threading
 import time
 import base64
+from dataclasses import dataclass
 from datetime import datetime
+from typing import Any, List, Optional
 
 import cv2
 import numpy as np
@@ -9,49 +17,302 @@ import requests
 
 # Optional: import face_recognition with a helpful error if missing
 try:
+    import dlib
     import face_recognition
 except Exception as e:
     raise SystemExit("face_recognition is required. Install with: pip install face_recognition opencv-python numpy requests\nError: " + str(e))
 
 
-def load_known_faces(backend_url: str):
+def _kernels_source_hash() -> int:
+    # Must match kernels.source_hash(), which is baked into the AOT module at build time
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kernels.py")
+    with open(path, "rb") as f:
+        return int(hashlib.sha256(f.read()).hexdigest()[:15], 16)
+
+
+def _load_best_match():
+    """Parallel Numba JIT kernel (cached on disk); the single-threaded AOT build only when
+    numba is not installed and it was built from the current kernels.py; else None (NumPy)"""
+    try:
+        from kernels import best_match as jit_best_match
+        return jit_best_match
+    except Exception:
+        pass
+    try:
+        import face_kernels
+        if face_kernels.source_hash() == _kernels_source_hash():
+            return face_kernels.best_match
+        print("Ignoring face_kernels: built from an older kernels.py; rerun python kernels.py")
+    except Exception:
+        pass
+    return None
+
+
+# Optional: compiled matching kernel; falls back to NumPy if unavailable
+best_match = _load_best_match()
+
+# Optional: simsimd provides runtime-dispatched SIMD distance kernels (AVX2/AVX-512/NEON)
+try:
+    import simsimd
+except Exception:
+    simsimd = None
+
+
+# Must match ENCODING_I8_RANGE in the backend (main.py)
+ENCODING_I8_RANGE = 0.3
+ENCODING_I8_SCALE = ENCODING_I8_RANGE / 127
+
+# Faces per frame covered by the preallocated match buffers; busier frames allocate
+MAX_FACES = 32
+
+# Above PREFILTER_MIN_KNOWN students, rank by Hamming distance of sign bits first and
+# compute exact distances only for the PREFILTER_TOP_K closest codes
+PREFILTER_MIN_KNOWN = 1000
+PREFILTER_TOP_K = 32
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+@dataclass
+class KnownFaces:
+    ids: List[str]
+    names: List[str]
+    matrix: np.ndarray  # (N, 128) float32, C-contiguous
+    sq: np.ndarray  # (N,) float32 squared norms of matrix rows
+    i8: np.ndarray  # (N, 128) int8 quantized copy of matrix
+    signs: np.ndarray  # (N, 16) uint8 packed sign bits of matrix
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def quantize_encodings(encodings: np.ndarray) -> np.ndarray:
+    return np.clip(np.round(encodings / ENCODING_I8_SCALE), -127, 127).astype(np.int8)
+
+
+def sign_codes(encodings: np.ndarray) -> np.ndarray:
+    """128-bit sign codes, (N, 128) -> (N, 16) uint8"""
+    return np.packbits(encodings > 0, axis=1)
+
+
+def _known_faces(ids: List[str], names: List[str], matrix: np.ndarray, i8: Optional[np.ndarray] = None) -> KnownFaces:
+    # Contiguous (N, 128) float32 matrix with cached squared norms,
+    # so per-frame matching is a single GEMM instead of one call per face
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32).reshape(-1, 128)
+    known_sq = np.einsum("ij,ij->i", matrix, matrix)
+    if i8 is None:
+        i8 = quantize_encodings(matrix)
+    return KnownFaces(ids, names, matrix, known_sq, i8, sign_codes(matrix))
+
+
+def _load_known_faces_json(backend_url: str) -> KnownFaces:
     resp = requests.get(f"{backend_url}/students")
     resp.raise_for_status()
     students = resp.json()
     known_encodings = []
+    known_i8 = []
     known_ids = []
     known_names = []
     for s in students:
         enc = s.get("encoding")
         if enc and isinstance(enc, list) and len(enc) >= 128:
-            known_encodings.append(np.array(enc))
+            known_encodings.append(enc[:128])
+            i8 = s.get("encoding_i8")
+            known_i8.append(np.frombuffer(base64.b64decode(i8), dtype=np.int8) if i8 else None)
             known_ids.append(s.get("id") or s.get("_id"))
             known_names.append(s.get("name"))
-    return known_encodings, known_ids, known_names
 
+    known = _known_faces(known_ids, known_names, np.asarray(known_encodings, dtype=np.float32))
+    # Prefer the int8 codes stored by the backend; quantize locally for older records
+    for i, q in enumerate(known_i8):
+        if q is not None and q.shape == (128,):
+            known.i8[i] = q
+    return known
 
-def mark_present(backend_url: str, student_id: str, room_id: str, source: str = "agent"):
+
+def _write_atomic(path: str, content: bytes):
+    with open(path + ".tmp", "wb") as f:
+        f.write(content)
+    os.replace(path + ".tmp", path)
+
+
+def load_known_faces(backend_url: str, cache_dir: str = ".edge_cache") -> KnownFaces:
+    """Fetch the (N, 128) float32 encodings matrix and memory-map it from a local cache.
+
+    Falls back to the cached copy when the backend is unreachable, and to the
+    JSON /students endpoint when the backend has no binary endpoint.
+    """
+    npy_path = os.path.join(cache_dir, "encodings.npy")
+    ids_path = os.path.join(cache_dir, "ids.json")
     try:
-        requests.post(f"{backend_url}/attendance/mark", json={
-            "student_id": student_id,
-            "room_id": room_id,
-            "timestamp": datetime.utcnow().isoformat(),
-            "source": source,
-        }, timeout=5)
-    except Exception:
-        pass
+        resp = requests.get(f"{backend_url}/students/encodings.npz", timeout=30)
+        if resp.status_code == 404:
+            return _load_known_faces_json(backend_url)
+        resp.raise_for_status()
+
+        # Matrix, ids and names come from one response, so they describe the same roster
+        with np.load(io.BytesIO(resp.content)) as npz:
+            matrix = np.asarray(npz["encodings"], dtype=np.float32).reshape(-1, 128)
+            rows = [{"id": i, "name": n} for i, n in zip(npz["ids"].tolist(), npz["names"].tolist())]
+        if matrix.shape[0] != len(rows):
+            raise SystemExit(f"Backend returned {matrix.shape[0]} encodings for {len(rows)} ids")
+
+        os.makedirs(cache_dir, exist_ok=True)
+        buf = io.BytesIO()
+        np.save(buf, matrix)
+        _write_atomic(npy_path, buf.getvalue())
+        _write_atomic(ids_path, json.dumps(rows).encode("utf-8"))
+    except requests.RequestException as e:
+        if not (os.path.exists(npy_path) and os.path.exists(ids_path)):
+            raise
+        print(f"Backend unavailable ({e}); using cached encodings from {cache_dir}")
+
+    with open(ids_path) as f:
+        rows = json.load(f)
+    # Copy-on-write map: served from the page cache, but still a writable array for the kernels
+    matrix = np.load(npy_path, mmap_mode="c")
+    if matrix.shape[0] != len(rows):
+        raise SystemExit(f"Cached encodings ({matrix.shape[0]}) and ids ({len(rows)}) are out of sync; delete {cache_dir}")
+    return _known_faces([r["id"] for r in rows], [r.get("name") for r in rows], matrix)
+
+
+class MatchBuffers:
+    """Per-frame scratch arrays, allocated once so the hot path does not churn the allocator"""
+
+    def __init__(self, n_known: int, max_faces: int = MAX_FACES):
+        self.max_faces = max_faces
+        self.E = np.empty((max_faces, 128), dtype=np.float32)
+        self.E_sq = np.empty(max_faces, dtype=np.float32)
+        self.E_i8 = np.empty((max_faces, 128), dtype=np.int8)
+        self.scratch = np.empty((max_faces, 128), dtype=np.float32)
+        self.dists = np.empty((max_faces, n_known), dtype=np.float32)
 
+    def load(self, encodings) -> np.ndarray:
+        """Copy the frame's encodings into the (F, 128) float32 buffer and return that view"""
+        E = self.E[:len(encodings)]
+        for i, enc in enumerate(encodings):
+            E[i] = enc
+        return E
 
-def log_unknown(backend_url: str, room_id: str, snapshot_b64: str):
+
+def face_distances(known: KnownFaces, encodings, bufs: Optional[MatchBuffers] = None) -> np.ndarray:
+    """(faces x known) Euclidean distances via ||a-b||^2 = ||a||^2 + ||b||^2 - 2a.b"""
+    f = len(encodings)
+    if bufs is None or f > bufs.max_faces:
+        bufs = MatchBuffers(len(known), f)
+    E = bufs.load(encodings)
+    dists = bufs.dists[:f]
+    if simsimd is not None:
+        # int8 path: 4x less data than float32 and VNNI/SDOT kernels where the CPU has them
+        q = bufs.scratch[:f]
+        np.multiply(E, 1.0 / ENCODING_I8_SCALE, out=q)
+        np.clip(np.rint(q, out=q), -127, 127, out=q)
+        E_i8 = bufs.E_i8[:f]
+        np.copyto(E_i8, q, casting="unsafe")
+        simsimd.cdist(E_i8, known.i8, metric="sqeuclidean", out=dists, out_dtype="float32")
+        dists *= ENCODING_I8_SCALE * ENCODING_I8_SCALE
+        return np.sqrt(dists, out=dists)
+    E_sq = np.einsum("ij,ij->i", E, E, out=bufs.E_sq[:f])
+    np.dot(E, known.matrix.T, out=dists)
+    dists *= -2.0
+    dists += known.sq
+    dists += E_sq[:, None]
+    return np.sqrt(np.maximum(dists, 0.0, out=dists), out=dists)
+
+
+def _match_prefiltered(known: KnownFaces, E: np.ndarray, tolerance: float):
+    # Hamming distance on packed sign bits: XOR + popcount over 16 bytes per known face
+    ham = _POPCOUNT8[np.bitwise_xor(known.signs[None, :, :], sign_codes(E)[:, None, :])].sum(axis=2, dtype=np.uint16)
+    k = min(PREFILTER_TOP_K, len(known))
+    candidates = np.argpartition(ham, k - 1, axis=1)[:, :k]
+    diff = known.matrix[candidates] - E[:, None, :]
+    dists = np.sqrt(np.einsum("fkd,fkd->fk", diff, diff))
+    pick = dists.argmin(axis=1)
+    rows = np.arange(len(E))
+    return candidates[rows, pick], dists[rows, pick] <= tolerance
+
+
+def detect_faces(detector, rgb: np.ndarray, upsample: int):
+    """Run a dlib HOG detector and return face_recognition-style (top, right, bottom, left) boxes"""
+    h, w = rgb.shape[:2]
+    return [(max(r.top(), 0), min(r.right(), w), min(r.bottom(), h), max(r.left(), 0)) for r in detector(rgb, upsample)]
+
+
+def match_faces(known: KnownFaces, encodings, tolerance: float, bufs: Optional[MatchBuffers] = None):
+    """Return (best_index, hit) arrays for each face encoding"""
+    if len(known) > PREFILTER_MIN_KNOWN:
+        if bufs is None or len(encodings) > bufs.max_faces:
+            bufs = MatchBuffers(len(known), len(encodings))
+        return _match_prefiltered(known, bufs.load(encodings), tolerance)
+    if best_match is not None:
+        if bufs is None or len(encodings) > bufs.max_faces:
+            bufs = MatchBuffers(len(known), len(encodings))
+        idx, _ = best_match(known.matrix, known.sq, bufs.load(encodings), np.float32(tolerance))
+        return idx, idx >= 0
+    dists = face_distances(known, encodings, bufs)
+    best = dists.argmin(axis=1)
+    return best, dists[np.arange(len(best)), best] <= tolerance
+
+
+# Network I/O runs on a background thread so a slow backend never stalls the capture loop
+_outbox: "queue.Queue" = queue.Queue(maxsize=256)
+_uploader: Optional[threading.Thread] = None
+
+
+def _upload_worker():
+    # One keep-alive session for all posts: no TCP/TLS handshake per mark
+    sess = requests.Session()
+    while True:
+        item = _outbox.get()
+        if item is None:
+            break
+        url, kwargs = item
+        try:
+            sess.post(url, timeout=5, **kwargs)
+        except Exception:
+            pass
+
+
+def start_uploader():
+    global _uploader
+    if _uploader is None:
+        _uploader = threading.Thread(target=_upload_worker, name="edge-uploader", daemon=True)
+        _uploader.start()
+
+
+def stop_uploader(timeout: float = 5.0):
+    """Flush queued posts (bounded by timeout) and stop the worker"""
+    global _uploader
+    if _uploader is not None:
+        _outbox.put(None)
+        _uploader.join(timeout)
+        _uploader = None
+
+
+def _enqueue(url: str, **kwargs: Any):
+    start_uploader()
     try:
-        requests.post(f"{backend_url}/unknown", json={
-            "room_id": room_id,
-            "snapshot_b64": snapshot_b64,
-        }, timeout=5)
-    except Exception:
+        _outbox.put_nowait((url, kwargs))
+    except queue.Full:
         pass
 
 
+def mark_present(backend_url: str, student_id: str, room_id: str, source: str = "agent"):
+    _enqueue(f"{backend_url}/attendance/mark", json={
+        "student_id": student_id,
+        "room_id": room_id,
+        "timestamp": datetime.utcnow().isoformat(),
+        "source": source,
+    })
+
+
+def log_unknown(backend_url: str, room_id: str, snapshot_jpeg: bytes):
+    # Raw JPEG as multipart: no base64 inflation or encoding work on the capture thread
+    _enqueue(f"{backend_url}/unknown", data={
+        "room_id": room_id,
+        "timestamp": datetime.utcnow().isoformat(),
+    }, files={"snapshot": ("face.jpg", snapshot_jpeg, "image/jpeg")})
+
+
 def main():
     parser = argparse.ArgumentParser(description="Edge Agent for AI Attendance (per room)")
     parser.add_argument("--backend", required=True, help="Backend base URL, e.g., http://localhost:8000")
@@ -60,6 +321,13 @@ def main():
     parser.add_argument("--scale", type=float, default=0.25, help="Frame downscale for faster processing (0.25 recommended)")
     parser.add_argument("--tolerance", type=float, default=0.5, help="Face match tolerance (lower is stricter)")
     parser.add_argument("--unknown", action="store_true", help="Log unknown faces to backend")
+    parser.add_argument("--cache-dir", default=".edge_cache", help="Where the known encodings matrix is cached between restarts")
+    parser.add_argument("--model", choices=["auto", "hog", "cnn"], default="auto", help="Face detector; auto uses cnn when dlib was built with CUDA")
+    parser.add_argument("--upsample", type=int, default=0, help="Detector upsampling passes; raise to 1 if distant faces are missed")
+    parser.add_argument("--no-opencl", action="store_true", help="Disable OpenCV's OpenCL (UMat) path for frame preprocessing")
+    parser.add_argument("--process-every", type=int, default=3, help="Run recognition on every Nth frame (1 = every frame)")
+    parser.add_argument("--motion-threshold", type=float, default=2.0, help="Mean grayscale diff below which face locations are reused")
+    parser.add_argument("--redetect-every", type=int, default=30, help="Force face detection after this many reused processed frames")
     args = parser.parse_args()
 
     backend = args.backend.rstrip('/')
@@ -75,66 +343,109 @@ def main():
     if not cap.isOpened():
         raise SystemExit("Could not open camera " + str(args.camera))
 
-    known_encodings, known_ids, known_names = load_known_faces(backend)
-    print(f"Loaded {len(known_encodings)} known encodings")
+    # dlib built without SIMD falls back to SSE2 and runs several times slower
+    if not (getattr(dlib, "USE_AVX_INSTRUCTIONS", False) or getattr(dlib, "USE_NEON_INSTRUCTIONS", False)):
+        print("Warning: dlib was built without AVX/NEON; rebuild it with ./install_edge.sh for faster recognition")
+
+    # The CNN detector is only practical when dlib runs it on the GPU
+    model = args.model
+    if model == "auto":
+        model = "cnn" if getattr(dlib, "DLIB_USE_CUDA", False) else "hog"
+    print(f"Using {model} face detector")
+    # Reuse one HOG detector and call it directly so upsampling is under our control
+    hog_detector = dlib.get_frontal_face_detector() if model == "hog" else None
+
+    # Transparent API: only worth it when OpenCV actually has an OpenCL device
+    use_opencl = not args.no_opencl and cv2.ocl.haveOpenCL()
+    cv2.ocl.setUseOpenCL(use_opencl)
+
+    known = load_known_faces(backend, args.cache_dir)
+    print(f"Loaded {len(known)} known encodings")
+    bufs = MatchBuffers(len(known))
+    start_uploader()
 
     last_mark = {}
+    frame_idx = 0
+    prev_gray = None
+    face_locations = []
+    since_detect = 0
+    overlays = []
 
-    while True:
-        ok, frame = cap.read()
-        if not ok:
-            time.sleep(0.1)
-            continue
-
-        # Resize for speed
-        small = cv2.resize(frame, (0, 0), fx=args.scale, fy=args.scale)
-        rgb_small = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
-
-        face_locations = face_recognition.face_locations(rgb_small)
-        face_encodings = face_recognition.face_encodings(rgb_small, face_locations)
-
-        for enc, (top, right, bottom, left) in zip(face_encodings, face_locations):
-            if len(known_encodings) > 0:
-                matches = face_recognition.compare_faces(known_encodings, enc, tolerance=args.tolerance)
-                face_distances = face_recognition.face_distance(known_encodings, enc)
-                best_match_index = np.argmin(face_distances) if len(face_distances) else None
-            else:
-                matches = []
-                best_match_index = None
-
-            name_to_show = "Unknown"
-            student_id = None
-
-            if best_match_index is not None and matches[best_match_index]:
-                student_id = known_ids[best_match_index]
-                name_to_show = known_names[best_match_index]
-
-                # Rate limit marking to once per 10 seconds per student
-                now = time.time()
-                if now - last_mark.get(student_id, 0) > 10:
-                    mark_present(backend, student_id, args.room_id)
-                    last_mark[student_id] = now
-            else:
-                if args.unknown:
-                    # Crop and encode snapshot
+    # Ctrl-C or an error must still flush queued marks and release the camera
+    try:
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                time.sleep(0.1)
+                continue
+
+            # Temporal downsample: recognise on every Nth frame, redraw last results in between
+            frame_idx += 1
+            if frame_idx % max(args.process_every, 1) == 0:
+                # Resize for speed; with OpenCL the resize and colour conversions stay on the GPU
+                # and only the small RGB image is downloaded
+                src = cv2.UMat(frame) if use_opencl else frame
+                small = cv2.resize(src, (0, 0), fx=args.scale, fy=args.scale)
+                rgb_small = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
+                rgb_small = np.ascontiguousarray(rgb_small.get() if use_opencl else rgb_small)
+
+                # Motion gate: on a static scene reuse the previous face locations and only re-encode
+                gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+                static = prev_gray is not None and cv2.mean(cv2.absdiff(gray, prev_gray))[0] < args.motion_threshold
+                prev_gray = gray
+                if static and face_locations and since_detect < args.redetect_every:
+                    since_detect += 1
+                else:
+                    if hog_detector is not None:
+                        face_locations = detect_faces(hog_detector, rgb_small, args.upsample)
+                    else:
+                        face_locations = face_recognition.face_locations(rgb_small, number_of_times_to_upsample=args.upsample, model=model)
+                    since_detect = 0
+                face_encodings = face_recognition.face_encodings(rgb_small, face_locations, num_jitters=1)
+
+                # Match every face in the frame against all known encodings at once
+                if face_encodings and len(known) > 0:
+                    best, hits = match_faces(known, face_encodings, args.tolerance, bufs)
+                else:
+                    best = hits = [None] * len(face_encodings)
+
+                overlays = []
+                for best_match_index, hit, (top, right, bottom, left) in zip(best, hits, face_locations):
+                    name_to_show = "Unknown"
+                    student_id = None
                     t, r, b, l = int(top/args.scale), int(right/args.scale), int(bottom/args.scale), int(left/args.scale)
-                    crop = frame[t:b, l:r]
-                    _, buf = cv2.imencode('.jpg', crop)
-                    b64 = base64.b64encode(buf).decode('utf-8')
-                    log_unknown(backend, args.room_id, b64)
-
-            # Draw rectangle (optional for local preview)
-            t, r, b, l = int(top/args.scale), int(right/args.scale), int(bottom/args.scale), int(left/args.scale)
-            cv2.rectangle(frame, (l, t), (r, b), (0, 255, 0) if student_id else (0, 0, 255), 2)
-            cv2.putText(frame, name_to_show, (l, t - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
-
-        # Show window for local monitoring
-        cv2.imshow('Attendance - Room', frame)
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
 
-    cap.release()
-    cv2.destroyAllWindows()
+                    if hit:
+                        student_id = known.ids[best_match_index]
+                        name_to_show = known.names[best_match_index]
+
+                        # Rate limit marking to once per 10 seconds per student
+                        now = time.time()
+                        if now - last_mark.get(student_id, 0) > 10:
+                            mark_present(backend, student_id, args.room_id)
+                            last_mark[student_id] = now
+                    else:
+                        if args.unknown:
+                            # Crop and encode snapshot
+                            crop = frame[t:b, l:r]
+                            _, buf = cv2.imencode('.jpg', crop)
+                            log_unknown(backend, args.room_id, buf.tobytes())
+
+                    overlays.append(((l, t, r, b), name_to_show, student_id is not None))
+
+            # Draw rectangles (optional for local preview)
+            for (l, t, r, b), name_to_show, matched in overlays:
+                cv2.rectangle(frame, (l, t), (r, b), (0, 255, 0) if matched else (0, 0, 255), 2)
+                cv2.putText(frame, name_to_show, (l, t - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
+
+            # Show window for local monitoring
+            cv2.imshow('Attendance - Room', frame)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+    finally:
+        cap.release()
+        cv2.destroyAllWindows()
+        stop_uploader()
 
 
 if __name__ == "__main__":
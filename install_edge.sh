@@ -0,0 +1,37 @@
+#!/bin/bash
+# Build dlib from source with SIMD enabled, then install the edge agent dependencies.
+# Prebuilt/default dlib builds can silently fall back to SSE2, which makes
+# face_locations/face_encodings several times slower.
+set -e
+
+ARCH=$(uname -m)
+echo "Building dlib for $ARCH..."
+
+case "$ARCH" in
+  x86_64|amd64)
+    export DLIB_USE_AVX_INSTRUCTIONS=1
+    export CMAKE_ARGS="-DUSE_AVX_INSTRUCTIONS=ON -DUSE_SSE4_INSTRUCTIONS=ON"
+    export CFLAGS="-O3 -mavx -mfma"
+    export CXXFLAGS="$CFLAGS"
+    ;;
+  aarch64|arm64)
+    export CMAKE_ARGS="-DUSE_NEON_INSTRUCTIONS=ON"
+    export CFLAGS="-O3 -march=armv8-a+simd"
+    export CXXFLAGS="$CFLAGS"
+    ;;
+  armv7l)
+    export CMAKE_ARGS="-DUSE_NEON_INSTRUCTIONS=ON"
+    export CFLAGS="-O3 -mfpu=neon"
+    export CXXFLAGS="$CFLAGS"
+    ;;
+  *)
+    echo "Unknown architecture $ARCH, building dlib with default flags"
+    ;;
+esac
+
+# --force-reinstall: an existing (possibly SSE2-only) dlib would otherwise be kept as "already satisfied"
+pip install --force-reinstall --no-deps --no-binary dlib --no-cache-dir dlib
+pip install face_recognition opencv-python numpy requests
+
+python -c "import dlib; print('dlib AVX:', getattr(dlib, 'USE_AVX_INSTRUCTIONS', False), 'NEON:', getattr(dlib, 'USE_NEON_INSTRUCTIONS', False), 'CUDA:', getattr(dlib, 'DLIB_USE_CUDA', False))"
+echo "Edge agent dependencies installed"
@@ -0,0 +1,78 @@
+"""
+Compiled face-matching kernels for the edge agent.
+
+best_match is compiled eagerly for one pinned signature with cache=True, so
+the machine code is written next to this file on first run and reloaded on
+every later start instead of being JIT-compiled again.
+
+On machines without numba at runtime, an ahead-of-time extension can be built
+once (on a machine with numba) and shipped instead:
+  python kernels.py
+This writes face_kernels.<ext> next to this file. It is single-threaded and
+edge_agent only uses it when numba is not installed and it was built from the
+current kernels.py (checked via source_hash).
+"""
+
+import hashlib
+import os
+
+import numpy as np
+from numba import njit, prange
+
+BEST_MATCH_SIG = "Tuple((i4[:], f4[:]))(f4[:,::1], f4[:], f4[:,::1], f4)"
+
+
+@njit(BEST_MATCH_SIG, cache=True, fastmath=True, parallel=True)
+def best_match(K, Ksq, E, tol):
+    """Fused nearest-known search: best index per face (-1 if over tol) and its distance"""
+    F = E.shape[0]
+    N = K.shape[0]
+    best_idx = np.full(F, -1, dtype=np.int32)
+    best_dist = np.full(F, np.inf, dtype=np.float32)
+    for f in prange(F):
+        e_sq = np.float32(0.0)
+        for d in range(K.shape[1]):
+            e_sq += E[f, d] * E[f, d]
+        min_s = np.float32(np.inf)
+        min_j = -1
+        for j in range(N):
+            dot = np.float32(0.0)
+            for d in range(K.shape[1]):
+                dot += E[f, d] * K[j, d]
+            s = Ksq[j] + e_sq - np.float32(2.0) * dot
+            if s < min_s:
+                min_s = s
+                min_j = j
+        if min_j >= 0:
+            dist = np.float32(np.sqrt(max(min_s, np.float32(0.0))))
+            best_dist[f] = dist
+            if dist <= tol:
+                best_idx[f] = min_j
+    return best_idx, best_dist
+
+
+def source_hash() -> int:
+    """Hash of this file; edge_agent._kernels_source_hash() must compute the same value"""
+    with open(os.path.abspath(__file__), "rb") as f:
+        return int(hashlib.sha256(f.read()).hexdigest()[:15], 16)
+
+
+def build_aot(output_dir: str = os.path.dirname(os.path.abspath(__file__))):
+    """Compile best_match into the face_kernels extension module (single-threaded; pycc has no prange)"""
+    from numba.pycc import CC
+
+    cc = CC("face_kernels")
+    cc.output_dir = output_dir
+    cc.export("best_match", BEST_MATCH_SIG)(best_match.py_func)
+
+    built_hash = source_hash()
+
+    @cc.export("source_hash", "i8()")
+    def aot_source_hash():
+        return built_hash
+    cc.compile()
+
+
+if __name__ == "__main__":
+    build_aot()
+    print("Built face_kernels extension")
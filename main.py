@@ -1,15 +1,24 @@
 import os
+import io
+import csv
+import itertools
+import time
+import base64
 from datetime import datetime, timedelta, timezone, date
 from typing import List, Optional, Dict, Any
 
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, File, Form, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, ORJSONResponse, Response
 from pydantic import BaseModel, Field
+import numpy as np
+from bson import Binary, ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 from database import db, create_document, get_documents
 
-app = FastAPI(title="AI Attendance Backend")
+app = FastAPI(title="AI Attendance Backend", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -21,11 +30,67 @@ app.add_middleware(
 
 # ---------- Utility ----------
 
-def utc_start_end_for_day(day: Optional[date] = None):
-    d = day or datetime.utcnow().date()
+# (epoch minute, start, end) for today's window; minutes never straddle a UTC midnight
+_DAY_CACHE = (None, None, None)
+
+
+def _day_window(d: date):
     start = datetime(d.year, d.month, d.day, tzinfo=timezone.utc)
-    end = start + timedelta(days=1)
-    return start, end
+    return start, start + timedelta(days=1)
+
+
+def utc_start_end_for_day(day: Optional[date] = None):
+    global _DAY_CACHE
+    if day is not None:
+        return _day_window(day)
+    # Key and date come from one clock read so they always agree across midnight
+    now = time.time()
+    minute = int(now // 60)
+    # Read the global once: another worker thread may swap it between two reads
+    cached = _DAY_CACHE
+    if cached[0] != minute:
+        cached = (minute, *_day_window(datetime.fromtimestamp(now, timezone.utc).date()))
+        _DAY_CACHE = cached
+    return cached[1], cached[2]
+
+
+# Face encodings lie well inside [-ENCODING_I8_RANGE, ENCODING_I8_RANGE]; the edge agent uses the same scale
+ENCODING_I8_RANGE = 0.3
+
+
+def quantize_encoding(encoding: List[float]) -> Binary:
+    """Quantize a 128-d float encoding to int8 bytes with a fixed symmetric scale"""
+    v = np.asarray(encoding, dtype=np.float32)
+    q = np.clip(np.round(v * (127 / ENCODING_I8_RANGE)), -127, 127).astype(np.int8)
+    return Binary(q.tobytes())
+
+
+def pack_encoding(encoding: List[float]) -> Binary:
+    """Pack a 128-d encoding as little-endian float32 bytes (512 B instead of 128 BSON doubles)"""
+    return Binary(np.asarray(encoding, dtype="<f4").tobytes())
+
+
+def encoding_array(value: Any) -> Optional[np.ndarray]:
+    """Stored encoding (float32 Binary, or a legacy list of doubles) as a (128,) float32 array"""
+    if isinstance(value, bytes) and len(value) >= 128 * 4:
+        return np.frombuffer(value, dtype="<f4", count=128)
+    if isinstance(value, list) and len(value) >= 128:
+        return np.asarray(value[:128], dtype=np.float32)
+    return None
+
+
+def serialize_student(doc: Dict[str, Any]):
+    # Keep the public JSON contract: encoding is still a list of floats in responses
+    # A malformed stored blob is reported as no encoding rather than failing the whole list
+    if doc and isinstance(doc.get("encoding"), bytes):
+        arr = encoding_array(doc["encoding"])
+        doc = {**doc, "encoding": arr.tolist() if arr is not None else None}
+    return serialize_doc(doc)
+
+
+# Besides _id, the only fields that can hold an ObjectId or binary payload
+OBJECT_ID_FIELDS = ("room_id", "student_id")
+BINARY_FIELDS = ("encoding_i8", "snapshot")
 
 
 def serialize_doc(doc: Dict[str, Any]):
@@ -34,17 +99,37 @@ def serialize_doc(doc: Dict[str, Any]):
     out = {**doc}
     if "_id" in out:
         out["id"] = str(out.pop("_id"))
-    # Stringify any nested ObjectIds just in case
-    for k, v in list(out.items()):
-        try:
-            from bson import ObjectId  # type: ignore
-            if isinstance(v, ObjectId):
-                out[k] = str(v)
-        except Exception:
-            pass
+    for k in OBJECT_ID_FIELDS:
+        v = out.get(k)
+        if isinstance(v, ObjectId):
+            out[k] = str(v)
+    for k in BINARY_FIELDS:
+        v = out.get(k)
+        if isinstance(v, bytes):
+            out[k] = base64.b64encode(v).decode("ascii")
     return out
 
 
+# ---------- Startup ----------
+
+@app.on_event("startup")
+def ensure_indexes():
+    if db is None:
+        return
+    try:
+        db["attendance"].create_index([("timestamp", 1), ("room_id", 1)])
+        db["attendance"].create_index([("student_id", 1), ("room_id", 1), ("timestamp", 1)])
+        # Older rows have no day field; the partial filter keeps them out of the unique index
+        db["attendance"].create_index(
+            [("student_id", 1), ("room_id", 1), ("day", 1)],
+            unique=True,
+            partialFilterExpression={"day": {"$type": "string"}},
+        )
+        db["student"].create_index([("room_id", 1)])
+    except Exception as e:
+        print(f"Could not create indexes: {str(e)[:80]}")
+
+
 # ---------- Schemas for requests ----------
 
 class RoomIn(BaseModel):
@@ -76,7 +161,6 @@ class ManualOverrideIn(BaseModel):
 class UnknownFaceIn(BaseModel):
     room_id: str
     timestamp: Optional[datetime] = None
-    snapshot_b64: Optional[str] = None
     note: Optional[str] = None
 
 
@@ -121,7 +205,7 @@ def test_database():
 @app.post("/rooms")
 def create_room(room: RoomIn):
     room_id = create_document("room", room.dict())
-    created = db["room"].find_one({"_id": db["room"].inserted_id}) if False else db["room"].find_one({"_id": __import__("bson").ObjectId(room_id)})
+    created = db["room"].find_one({"_id": ObjectId(room_id)})
     return serialize_doc(created)
 
 
@@ -135,16 +219,47 @@ def list_rooms():
 
 @app.post("/students")
 def create_student(student: StudentIn):
-    student_id = create_document("student", student.dict())
-    created = db["student"].find_one({"_id": __import__("bson").ObjectId(student_id)})
-    return serialize_doc(created)
+    data = student.dict()
+    if data.get("encoding"):
+        if len(data["encoding"]) != 128:
+            raise HTTPException(status_code=400, detail="encoding must have exactly 128 values")
+        data["encoding_i8"] = quantize_encoding(data["encoding"])
+        data["encoding"] = pack_encoding(data["encoding"])
+    student_id = create_document("student", data)
+    created = db["student"].find_one({"_id": ObjectId(student_id)})
+    return serialize_student(created)
 
 
 @app.get("/students")
 def list_students(room_id: Optional[str] = None):
     filt = {"room_id": room_id} if room_id else {}
     students = get_documents("student", filt)
-    return [serialize_doc(s) for s in students]
+    return [serialize_student(s) for s in students]
+
+
+@app.get("/students/encodings.npz")
+def student_encodings_npz(room_id: Optional[str] = None):
+    """All usable encodings as one .npz: encodings (N, 128) float32, ids (N,), names (N,).
+
+    Ids and names travel in the same response as the matrix, so row i always
+    belongs to ids[i] even if the roster changes between agent requests.
+    """
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not initialized")
+    filt: Dict[str, Any] = {"encoding": {"$ne": None}}
+    if room_id:
+        filt["room_id"] = room_id
+    rows, ids, names = [], [], []
+    for s in db["student"].find(filt, {"name": 1, "encoding": 1}).sort("_id", 1):
+        arr = encoding_array(s.get("encoding"))
+        if arr is not None:
+            rows.append(arr)
+            ids.append(str(s["_id"]))
+            names.append(s.get("name") or "")
+    encodings = np.stack(rows).astype(np.float32, copy=False) if rows else np.empty((0, 128), dtype=np.float32)
+    buf = io.BytesIO()
+    np.savez(buf, encodings=encodings, ids=np.array(ids, dtype=str), names=np.array(names, dtype=str))
+    return Response(buf.getvalue(), media_type="application/octet-stream")
 
 
 # ---------- Attendance ----------
@@ -155,25 +270,31 @@ def mark_attendance(payload: AttendanceMarkIn):
         raise HTTPException(status_code=500, detail="Database not initialized")
 
     ts = payload.timestamp or datetime.utcnow().replace(tzinfo=timezone.utc)
+    # Naive timestamps (the edge agent sends utcnow()) are UTC; aware ones are converted,
+    # so the day bucket always matches the UTC timestamp Mongo stores
+    ts = ts.astimezone(timezone.utc) if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
     start, end = utc_start_end_for_day(ts.date())
+    day = start.date().isoformat()
 
-    # Ensure single mark per day per student per room
-    existing = db["attendance"].find_one({
+    # Ensure single mark per day per student per room: one atomic upsert, and the unique
+    # (student_id, room_id, day) index turns a lost race into a DuplicateKeyError
+    filt = {
         "student_id": payload.student_id,
         "room_id": payload.room_id,
         "timestamp": {"$gte": start, "$lt": end},
-    })
-    if existing:
-        return serialize_doc(existing)
-
+    }
     doc = {
-        "student_id": payload.student_id,
-        "room_id": payload.room_id,
         "timestamp": ts,
+        "day": day,
         "source": payload.source or "agent",
     }
-    new_id = db["attendance"].insert_one(doc).inserted_id
-    created = db["attendance"].find_one({"_id": new_id})
+    try:
+        created = db["attendance"].find_one_and_update(
+            filt, {"$setOnInsert": doc}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Lost the race: the winner holds the unique (student_id, room_id, day) key
+        created = db["attendance"].find_one({"student_id": payload.student_id, "room_id": payload.room_id, "day": day})
     return serialize_doc(created)
 
 
@@ -212,94 +333,105 @@ def export_attendance_csv(date_str: Optional[str] = Query(None, description="YYY
     if room_id:
         filt["room_id"] = room_id
 
-    rows = list(db["attendance"].find(filt))
+    # Join names server-side; ids are stored as strings, so convert before the _id lookups
+    pipeline = [
+        {"$match": filt},
+        {"$addFields": {
+            "_sid": {"$convert": {"input": "$student_id", "to": "objectId", "onError": None, "onNull": None}},
+            "_rid": {"$convert": {"input": "$room_id", "to": "objectId", "onError": None, "onNull": None}},
+        }},
+        {"$lookup": {"from": "student", "localField": "_sid", "foreignField": "_id", "as": "_student"}},
+        {"$lookup": {"from": "room", "localField": "_rid", "foreignField": "_id", "as": "_room"}},
+        {"$project": {
+            "_id": 0,
+            "student_id": 1,
+            "room_id": 1,
+            "timestamp": 1,
+            "source": {"$ifNull": ["$source", "agent"]},
+            "student_name": {"$ifNull": [{"$arrayElemAt": ["$_student.name", 0]}, ""]},
+            "room_name": {"$ifNull": [{"$arrayElemAt": ["$_room.name", 0]}, ""]},
+        }},
+    ]
+    cursor = db["attendance"].aggregate(pipeline)
+
+    def generate_csv():
+        # Encode one row at a time through a reused buffer so the export never sits in memory
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        rows = (
+            [r.get("student_id") or "", r["student_name"], r.get("room_id") or "", r["room_name"],
+             (r.get("timestamp") or datetime.utcnow()).isoformat(), r["source"]]
+            for r in cursor
+        )
+        for row in itertools.chain([["student_id", "student_name", "room_id", "room_name", "timestamp", "source"]], rows):
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
 
-    # Build CSV
-    import csv
-    from io import StringIO
-
-    buffer = StringIO()
-    writer = csv.writer(buffer)
-    writer.writerow(["student_id", "student_name", "room_id", "room_name", "timestamp", "source"]) 
-
-    # Create lookup maps for names
-    student_ids = {r.get("student_id") for r in rows}
-    room_ids = {r.get("room_id") for r in rows}
-    students_map = {str(s["_id"]): s for s in db["student"].find({"_id": {"$in": [__import__("bson").ObjectId(sid) for sid in student_ids if sid]}})} if student_ids else {}
-    rooms_map = {str(rm["_id"]): rm for rm in db["room"].find({"_id": {"$in": [__import__("bson").ObjectId(rid) for rid in room_ids if rid]}})} if room_ids else {}
-
-    for r in rows:
-        sid = r.get("student_id")
-        rid = r.get("room_id")
-        s_name = students_map.get(sid, {}).get("name", "")
-        r_name = rooms_map.get(rid, {}).get("name", "")
-        writer.writerow([
-            sid or "",
-            s_name,
-            rid or "",
-            r_name,
-            (r.get("timestamp") or datetime.utcnow()).isoformat(),
-            r.get("source", "agent"),
-        ])
-
-    buffer.seek(0)
     filename = f"attendance_{d.isoformat()}" + (f"_{room_id}" if room_id else "") + ".csv"
-    return StreamingResponse(iter([buffer.getvalue()]), media_type="text/csv", headers={"Content-Disposition": f"attachment; filename={filename}"})
+    return StreamingResponse(generate_csv(), media_type="text/csv", headers={"Content-Disposition": f"attachment; filename={filename}"})
 
 
 # ---------- Unknown faces ----------
 
 @app.post("/unknown")
-def log_unknown(payload: UnknownFaceIn):
+def log_unknown(
+    room_id: str = Form(...),
+    timestamp: Optional[datetime] = Form(None),
+    note: Optional[str] = Form(None),
+    snapshot: Optional[UploadFile] = File(None),
+):
+    payload = UnknownFaceIn(room_id=room_id, timestamp=timestamp, note=note)
     ts = payload.timestamp or datetime.utcnow().replace(tzinfo=timezone.utc)
-    doc = {"room_id": payload.room_id, "timestamp": ts, "snapshot_b64": payload.snapshot_b64, "note": payload.note}
+    # Snapshot is stored as raw JPEG bytes (BSON Binary), not base64
+    data = snapshot.file.read() if snapshot is not None else None
+    doc = {"room_id": payload.room_id, "timestamp": ts, "snapshot": Binary(data) if data else None, "note": payload.note}
     new_id = db["unknown"].insert_one(doc).inserted_id
-    return serialize_doc(db["unknown"].find_one({"_id": new_id}))
+    return serialize_doc(db["unknown"].find_one({"_id": new_id}, {"snapshot": 0}))
 
 
 # ---------- Dashboard status ----------
 
 @app.get("/dashboard/status")
 def dashboard_status():
-    # Rooms
-    rooms = list(db["room"].find({}))
     start, end = utc_start_end_for_day()
 
-    # Attendance today
-    todays = list(db["attendance"].find({"timestamp": {"$gte": start, "$lt": end}}))
-
-    # Build present-by-room map
-    present_by_room: Dict[str, List[str]] = {}
-    for a in todays:
-        rid = a.get("room_id")
-        sid = a.get("student_id")
-        if rid and sid:
-            present_by_room.setdefault(rid, [])
-            if sid not in present_by_room[rid]:
-                present_by_room[rid].append(sid)
-
-    # Student counts per room
-    room_ids = [str(r["_id"]) for r in rooms]
-    students = list(db["student"].find({"room_id": {"$in": room_ids}}))
-    students_by_room: Dict[str, List[Dict[str, Any]]] = {}
-    for s in students:
-        rid = s.get("room_id")
-        students_by_room.setdefault(rid, []).append(s)
-
-    # Compose response
-    status = []
-    for r in rooms:
-        rid = str(r["_id"])
-        total = len(students_by_room.get(rid, []))
-        present_ids = present_by_room.get(rid, [])
-        status.append({
-            "id": rid,
-            "name": r.get("name"),
-            "present_count": len(present_ids),
-            "total": total,
-        })
-
-    return {"rooms": status}
+    # One pipeline per room: distinct students present today ($addToSet dedups server-side)
+    # and the number of students assigned to the room
+    pipeline = [
+        {"$addFields": {"_rid": {"$toString": "$_id"}}},
+        {"$lookup": {
+            "from": "attendance",
+            "let": {"rid": "$_rid"},
+            "pipeline": [
+                {"$match": {
+                    "$expr": {"$eq": ["$room_id", "$$rid"]},
+                    "timestamp": {"$gte": start, "$lt": end},
+                    "student_id": {"$nin": [None, ""]},
+                }},
+                {"$group": {"_id": None, "present": {"$addToSet": "$student_id"}}},
+            ],
+            "as": "_att",
+        }},
+        {"$lookup": {
+            "from": "student",
+            "let": {"rid": "$_rid"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$room_id", "$$rid"]}}},
+                {"$count": "n"},
+            ],
+            "as": "_stu",
+        }},
+        {"$project": {
+            "_id": 0,
+            "id": "$_rid",
+            "name": {"$ifNull": ["$name", None]},
+            "present_count": {"$size": {"$ifNull": [{"$arrayElemAt": ["$_att.present", 0]}, []]}},
+            "total": {"$ifNull": [{"$arrayElemAt": ["$_stu.n", 0]}, 0]},
+        }},
+    ]
+    return {"rooms": list(db["room"].aggregate(pipeline))}
 
 
 # ---------- Minimal schema endpoint (for reference) ----------
@@ -308,9 +440,9 @@ def dashboard_status():
 def schema_overview():
     return {
         "room": {"fields": ["name", "camera_url", "is_active"]},
-        "student": {"fields": ["name", "roll_no", "room_id", "photo_url", "encoding"]},
-        "attendance": {"fields": ["student_id", "room_id", "timestamp", "source"]},
-        "unknown": {"fields": ["room_id", "timestamp", "snapshot_b64", "note"]},
+        "student": {"fields": ["name", "roll_no", "room_id", "photo_url", "encoding", "encoding_i8"]},
+        "attendance": {"fields": ["student_id", "room_id", "timestamp", "day", "source"]},
+        "unknown": {"fields": ["room_id", "timestamp", "snapshot", "note"]},
     }
 
 
@@ -21,16 +21,18 @@ class Student(BaseModel):
     photo_url: Optional[str] = Field(None, description="Reference photo URL (for dashboard display)")
     
     # Store one primary encoding; edge agent may maintain multiple, but we keep a canonical vector here
-    encoding: Optional[List[float]] = Field(None, description="128-d face encoding vector from face_recognition")
+    encoding: Optional[List[float]] = Field(None, description="128-d face encoding vector from face_recognition; stored as BSON Binary of 128 little-endian float32")
+    encoding_i8: Optional[bytes] = Field(None, description="int8-quantized copy of encoding (scale 127/0.3), stored as BSON Binary")
 
 class Attendance(BaseModel):
     room_id: str = Field(..., description="Room ID")
     student_id: str = Field(..., description="Student ID")
     timestamp: datetime = Field(default_factory=datetime.utcnow, description="When attendance was captured (UTC)")
+    day: Optional[str] = Field(None, description="UTC day (YYYY-MM-DD) of timestamp; unique per student and room")
     source: str = Field("agent", description="Source of mark: agent/manual/api")
 
 class UnknownFace(BaseModel):
     room_id: str = Field(..., description="Room ID")
     timestamp: datetime = Field(default_factory=datetime.utcnow)
-    snapshot_b64: Optional[str] = Field(None, description="Optional base64 image snippet for later review")
+    snapshot: Optional[bytes] = Field(None, description="Optional raw JPEG snippet for later review (BSON Binary)")
     note: Optional[str] = Field(None)